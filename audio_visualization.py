@@ -1,32 +1,52 @@
 import matplotlib
+matplotlib.use('Agg')
+import matplotlib.patches
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy
-import scipy.io.wavfile
 import wave
 import scipy.signal
-import celluloid
-from celluloid import Camera
-from matplotlib.animation import FuncAnimation
+import scipy.fft
+import soundfile as sf
+from numba import njit
+from matplotlib.animation import FuncAnimation, FFMpegWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import time
-import random
-import ffmpeg
 import sys
+import os
+import collections
+import multiprocessing
+import subprocess
 
+# size of each frame of the circle animation, 1280x720
+FIGSIZE = (16, 9)
+DPI = 80
+# h264 encoder settings for the saved videos
+BITRATE = 4000
+ENCODER_ARGS = ['-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-threads', '0']
 
-def get_bin_average(column_no, bin_start, bin_end, Zxx):
-    """
-    get_bin_average gets the average of a range of elements in a particular frame (aka column) in Zxx
-    to calculate the value for one bin in one frame
 
-    Input: column_no - the timestep number in Zxx to take the average of
-           bin_start - the row number (counting from 0 Hz) that is the start of the range to
-                       take an average over for a bin (inclusive)
-           bin_end   - the end of the range (exclusive) starting in bin_start
-           Zxx       - the frequency domain 2DArray output from scipy short-time Fourier transform
-    Output: average of range of rows from bin_start to bin_end in the column column_no
+# STFT frame length and hop, and the periodic hann window scaled like scipy.signal.stft
+NPERSEG = 8192
+STEP = NPERSEG - 6721
+WIN = scipy.signal.windows.hann(NPERSEG, sym=False)
+WIN = (WIN / WIN.sum()).astype(np.float32)
+
+
+def get_bin_averages(magnitudes, boundaries, widths):
+    """
+    get_bin_averages averages the magnitudes of every frame over each bin in one vectorized pass
+    to calculate the values of all bins in all frames
+
+    Input: magnitudes - the absolute value of the frequency domain output of the short-time Fourier
+                        transform, shape (..., number of frames, number of frequencies)
+           boundaries - increasing frequency numbers (counting from 0 Hz) of the boundaries of each bin
+           widths     - array of the number of frequencies in each bin
+    Output: array of shape (..., number of frames, number of bins) holding the average of each bin in each frame
     """
-    return np.average(Zxx[bin_start:bin_end, column_no])
+    sums = np.add.reduceat(magnitudes[..., :boundaries[-1]], boundaries[:-1], axis=-1)
+    return sums / widths
 
 
 def wav_to_bins(filename, mono, bin_boundaries):
@@ -35,45 +55,45 @@ def wav_to_bins(filename, mono, bin_boundaries):
     transform (STFT) and then bins the result.
     Input: filename - name of .WAV file to input
            mono - a value in {True, False}. If True, signifies one channel; if False, signifies two channels.
-           bin_boundaries - an array specifying the boundaries of each bin
-    Output: an array of bins with dimension (number of bins, number of frames)
+           bin_boundaries - an array specifying the boundaries of each bin, counted in rows of the STFT
+                            from the highest frequency
+    Output: an array of bins with dimension (number of frames, number of bins)
     """
-    rate, data = scipy.io.wavfile.read(filename)
-    f0, t0, Zxx0 = scipy.signal.stft(data[:, 0], fs=rate, window='hann', nperseg=8192, noverlap=6721, nfft=None,
-                                     detrend=False, return_onesided=True, boundary='zeros', padded=True, axis=- 1)
-    zeros = np.zeros((Zxx0.shape[0], 1))
-    Zxx0 = np.concatenate((Zxx0, zeros), axis=1)
-    Zxx0 = np.flip(Zxx0, axis=0)
-
-    bins0 = np.zeros((len(bin_boundaries) - 1, Zxx0.shape[1]))
-
-    for column in range(Zxx0.shape[1]):
-        for i in range(len(bins0)):
-            bins0[i, column] = np.abs(get_bin_average(column, bin_boundaries[i], bin_boundaries[i + 1], Zxx0))
-
-    bins0 = normalization_and_zooming(bins0)
-
-    if (mono == False):
-        f1, t1, Zxx1 = scipy.signal.stft(data[:, 1], fs=rate, window='hann', nperseg=8192, noverlap=6721, nfft=None,
-                                         detrend=False, return_onesided=True, boundary='zeros', padded=True, axis=- 1)
-        zeros = np.zeros((Zxx1.shape[0], 1))
-        Zxx1 = np.concatenate((Zxx1, zeros), axis=1)
-        Zxx1 = np.flip(Zxx1, axis=0)
-
-        bins1 = np.zeros((len(bin_boundaries) - 1, Zxx1.shape[1]))
-
-        for column in range(Zxx1.shape[1]):
-            for i in range(len(bins1)):
-                bins1[i, column] = np.abs(get_bin_average(column, bin_boundaries[i], bin_boundaries[i + 1], Zxx1))
-
-        bins1 = normalization_and_zooming(bins1)
+    # float32 samples keep the whole STFT in float32/complex64
+    data, rate = sf.read(filename, dtype='float32', always_2d=True)
+    channels = data[:, :1] if mono else data[:, :2]
+    # remap the boundaries onto frequencies counting up from 0 Hz instead of flipping the STFT
+    nfreq = NPERSEG // 2 + 1
+    boundaries = [nfreq - b for b in reversed(bin_boundaries)]
+    widths = np.diff(boundaries).astype(np.float32)
+    # zero padding to match scipy.signal.stft with boundary='zeros' and padded=True
+    nextra = -channels.shape[0] % STEP
+    padded = np.pad(channels.T, ((0, 0), (NPERSEG // 2, NPERSEG // 2 + nextra)))
+    frames = np.lib.stride_tricks.sliding_window_view(padded, NPERSEG, axis=-1)[:, ::STEP]
+    # transform and bin the frames in blocks so that the windowed frames and the complex STFT
+    # (shape (number of channels, number of frames, number of frequencies)) of only one block,
+    # about 256 MB, are in memory at a time
+    frame_bytes = frames.shape[0] * (NPERSEG * 4 + nfreq * 12)
+    block = max(1, 2 ** 28 // frame_bytes)
+    # allocated with the empty last frame already in place
+    bins = np.zeros((frames.shape[0], frames.shape[1] + 1, len(widths)), dtype=np.float32)
+    for start in range(0, frames.shape[1], block):
+        end = min(start + block, frames.shape[1])
+        Zxx = scipy.fft.rfft(frames[:, start:end] * WIN, axis=-1, workers=-1)
+        # back to the order of bin_boundaries
+        bins[:, start:end] = get_bin_averages(np.abs(Zxx), boundaries, widths)[..., ::-1]
+        del Zxx
+
+    # all channels in one call, each with its own scale
+    bins = normalization_and_zooming(bins)
 
     if (mono == False):
-        return (bins0, bins1)
+        return (bins[0], bins[1])
     else:
-        return bins0
+        return bins[0]
 
 
+@njit(fastmath=True, cache=True)
 def normalization_and_zooming(bins):
     """
     normalization_and_zooming operates on the bins array in the following manner:
@@ -81,61 +101,104 @@ def normalization_and_zooming(bins):
         1. sets undefined numbers to the minimum of the array
         2. normalizes minimum of array to 0 and maximum of array to 1
         3. zooms in to the top 75% of the array for greater effect
-    Input: bins - (number of bins, number of frames) shape array
+    Each channel is normalized on its own. Since log is increasing, the minimum and maximum of the log
+    come from the smallest value (zeros counting as 1) and the largest value, so one pass finds both
+    and a second pass applies all of the steps.
+    Input: bins - (number of channels, number of frames, number of bins) shape C-contiguous float array,
+                  updated in place
     Output: normalized, zoomed in version of log(bins)
     """
-    bins[bins == 0] = 1
-    bins = np.log(bins)
-    # Normalization
-    bins[bins == 0] = np.amin(bins)
-    bins = bins - np.amin(bins)
-    bins = bins / np.amax(bins)
-    # Zooming in
-    bins[bins < 0.25] = 0.25
-    bins = bins - 0.25
-    bins = bins / np.amax(bins)
+    for values in bins.reshape(bins.shape[0], -1):
+        floor = 0.0
+        top = 0.0
+        has_zero = False
+        for x in values:
+            if (x == 0):
+                has_zero = True
+            elif (floor == 0 or x < floor):
+                floor = x
+            if (x > top):
+                top = x
+        if (floor == 0):
+            values[:] = 0
+            continue
+        # zeros become the smaller of log(1) = 0 and the log of the smallest nonzero value
+        if (has_zero and floor > 1):
+            floor = 1.0
+        low = np.log(floor)
+        span = np.log(top) - low
+        scale = 1 / span if span > 0 else 0.0
+        for i in range(values.shape[0]):
+            # Normalization
+            normalized = (np.log(max(values[i], floor)) - low) * scale
+            # Zooming in
+            values[i] = (max(normalized, 0.25) - 0.25) / 0.75
     return bins
 
 
-def find_points(threshold, horizon):
+def find_points(bins, threshold, horizon):
     """
     Used for the beat detection feature. find_points uses non-maximum suppression to find emphasis points.
-    Input: threshold - used to evaluate if each point should be added to the list of emphasis points
+    Input: bins      - (number of frames, number of bins) shape array
+           threshold - used to evaluate if each point should be added to the list of emphasis points
            horizon   - how far on each side to look
     Output: list of emphasis points
     """
-    test1 = np.average(bins0, axis=0)
-    keep = []
-    for i in range(test1.shape[0]):
-        neighbors = test1[max(0, i - horizon):min(test1.shape[0], i + horizon + 1)]
-        num_geq = 0
-        for neighbor in neighbors:
-            if (neighbor >= test1[i]):
-                num_geq += 1
-        result = (num_geq - 1) / (neighbors.shape[0] - 1)
-        if (result >= threshold):
-            keep.append(i)
-    return keep
+    test1 = np.average(bins, axis=1)
+    # pad with -inf so that positions past either end never count as neighbors >= a point
+    padded = np.pad(test1, horizon, constant_values=-np.inf)
+    neighbors = np.lib.stride_tricks.sliding_window_view(padded, 2 * horizon + 1)
+    num_geq = np.count_nonzero(neighbors >= test1[:, None], axis=1)
+    index = np.arange(test1.shape[0])
+    num_neighbors = np.minimum(index, horizon) + np.minimum(index[::-1], horizon)
+    result = (num_geq - 1) / num_neighbors
+    return np.nonzero(result >= threshold)[0].tolist()
+
+
+@njit(cache=True)
+def compute_colors(is_emphasis, palette):
+    """
+    Used for the color changing feature. compute_colors switches to the next palette color at each emphasis
+    point and darkens it by 10% on each frame in between.
+    Input: is_emphasis - boolean array, True at the emphasis points found by find_points
+           palette     - (number of emphasis points, 3) shape array of the RGB colors to switch to
+    Output: (number of frames, 3) shape array of the RGB background color of each frame
+    """
+    frame_colors = np.empty((is_emphasis.shape[0], 3))
+    color = np.ones(3)
+    next_color = 0
+    for i in range(is_emphasis.shape[0]):
+        if is_emphasis[i]:
+            color = palette[next_color]
+            next_color += 1
+        else:
+            color = color * 0.9
+        frame_colors[i] = color
+    return frame_colors
 
 
 def bar_mode(bins, names, save_name):
     """
     Makes a bar plot animation.
-    Input: bins      - (number of bins, number of frames) shape array
+    Input: bins      - (number of frames, number of bins) shape array
            names     - name of each bin
            save_name - name to save the animation as (must have .mp4 extension)
     """
     start = time.time()
 
-    fig = plt.figure()
-    camera = Camera(fig)
+    fig = plt.figure(dpi=DPI)
+    bars = plt.bar(names, bins[0], color='blue', width=0.4)
+    # fixed axis that fits the bars of every frame
+    plt.ylim(0, np.amax(bins) * 1.05)
 
-    for i in range(bins.shape[1]):
-        plt.bar(names, bins[:, i], color='blue', width=0.4)
-        camera.snap()
+    def update(i):
+        for bar, height in zip(bars, bins[i]):
+            bar.set_height(height)
+        return bars
 
-    animation = camera.animate()
-    animation.save(save_name, fps=30)
+    animation = FuncAnimation(fig, update, frames=bins.shape[0], blit=True, interval=1000 / 30)
+    writer = FFMpegWriter(fps=30, codec='h264', bitrate=BITRATE, extra_args=ENCODER_ARGS)
+    animation.save(save_name, writer=writer)
     print("time: ", time.time() - start)
 
 
@@ -149,94 +212,156 @@ def ratio(a, b):
     return b / (a + b)
 
 
-def circle_mode(bins0, bins1, save_name, color_changing, circle_width=15):
+# figure and artists of circle_mode, created once in each rendering process by setup_circle_figure
+circle_figure = None
+
+
+def setup_circle_figure(num_bins, circle_width):
+    """
+    Creates the figure of the circle animation in a rendering process. The artists are created
+    once and only their geometry and color change from frame to frame.
+    Input: num_bins - number of circles to draw
+           circle_width - width of the circles
+    """
+    global circle_figure
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    # the axes fill the whole frame; y shows the middle 9/16 of (0, 1) so that circles stay round
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim((0, 1))
+    ax.set_ylim((0.5 - 9 / 32, 0.5 + 9 / 32))
+    ax.set_axis_off()
+    colors = ['magenta', 'yellow', 'cyan', 'red', 'green', 'blue']
+    rectangle = matplotlib.patches.Rectangle((-0.5, -0.5), 2, 2, facecolor=(1, 1, 1))
+    ax.add_artist(rectangle)
+    circles = []
+    for j in range(num_bins):
+        circle = matplotlib.patches.Circle((0.5, 0.5), 0, color=colors[j % len(colors)], alpha=0.6, fill=False,
+                                           linewidth=circle_width)
+        ax.add_artist(circle)
+        circles.append(circle)
+    circle_figure = (fig, rectangle, circles)
+
+
+def render_circle_frames(centers, radii, frame_colors):
     """
-    Makes a circle animation.
+    Renders a run of frames of the circle animation in a rendering process.
+    Input: centers - (number of frames, number of bins) shape array of the x coordinates of the circles
+           radii - (number of frames, number of bins) shape array of the radii of the circles
+           frame_colors - background color of each frame
+    Output: the raw RGBA pixels of the frames, one after another
+    """
+    fig, rectangle, circles = circle_figure
+    frames = bytearray()
+    for i in range(len(frame_colors)):
+        rectangle.set_facecolor(frame_colors[i])
+        for j, circle in enumerate(circles):
+            circle.set_center((centers[i, j], 0.5))
+            circle.set_radius(radii[i, j])
+        fig.canvas.draw()
+        frames += fig.canvas.buffer_rgba()
+    return frames
+
+
+def circle_mode(bins0, bins1, save_name, color_changing, circle_width=15, audio_name=None):
+    """
+    Makes a circle animation. Frames are rendered in parallel by one process per CPU and piped to ffmpeg,
+    which adds the audio in the same pass.
     Input: bins0 - left channel
            bins1 - right channel
            save_name - name to save the animation as (must have .mp4 extension)
            color_changing - if True, background changes along with song
+           audio_name - the audio of the animation, must be .wav; if None, the video has no sound
     """
     start = time.time()
-    fig, ax = plt.subplots(figsize=(16, 9))
-    ax.set_position([0, -0.38888, 1, 1.77777])
-    camera = Camera(fig)
     if (bins1 is not None):
         mono = False
     else:
         mono = True
 
     if (color_changing == True):
-        points = find_points(27 / 30, 7)
-
-    color = (1, 1, 1)
-    colors = ['magenta', 'yellow', 'cyan', 'red', 'green', 'blue']
+        is_emphasis = np.zeros(bins0.shape[0], dtype=np.bool_)
+        is_emphasis[find_points(bins0, 27 / 30, 7)] = True
+        palette = np.random.default_rng().random((np.count_nonzero(is_emphasis), 3))
+        frame_colors = compute_colors(is_emphasis, palette)
+    else:
+        frame_colors = np.ones((bins0.shape[0], 3))
 
-    for i in range(bins0.shape[1]):
-        if (color_changing == True):
-            if (i in points):
-                color = (random.random(), random.random(), random.random())
-            else:
-                color = (color[0] * 0.9, color[1] * 0.9, color[2] * 0.9)
-        circles = []
-        if (mono == True):
-            for j in range(bins0.shape[0]):
-                circles.append(
-                    plt.Circle((0.5, 0.5), bins0[j, i] / 2, color=colors[j % len(colors)], alpha=0.6, fill=False,
-                               linewidth=circle_width))
-        else:
-            for j in range(bins0.shape[0]):
-                circles.append(plt.Circle((ratio(bins0[j, i], bins1[j, i]), 0.5), (bins0[j, i] + bins1[j, i]) / 4,
-                                          color=colors[j % len(colors)], alpha=0.6, fill=False, linewidth=circle_width))
-        rectangle = plt.Rectangle((-0.5, -0.5), 2, 2, facecolor=color)
-        ax.set_xlim((0, 1))
-        ax.set_ylim((0, 1))
-        plt.axis('off')
-        ax.add_artist(rectangle)
-        for circle in circles:
-            ax.add_artist(circle)
-        camera.snap()
-
-    animation = camera.animate()
-    animation.save(save_name, fps=30, writer='ffmpeg')
+    if (mono == True):
+        centers = np.full(bins0.shape, 0.5)
+        radii = bins0 / 2
+    else:
+        centers = ratio(bins0, bins1)
+        radii = (bins0 + bins1) / 4
+
+    width, height = FIGSIZE[0] * DPI, FIGSIZE[1] * DPI
+    command = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '%dx%d' % (width, height), '-r', '30',
+               '-i', '-']
+    if (audio_name is not None):
+        command += ['-i', audio_name, '-c:a', 'aac', '-shortest']
+    command += ['-vcodec', 'h264', '-b:v', '%dk' % BITRATE] + ENCODER_ARGS + [save_name]
+    ffmpeg_process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    # count only the CPUs this process may run on, not every core of the host
+    if hasattr(os, 'sched_getaffinity'):
+        num_workers = len(os.sched_getaffinity(0))
+    else:
+        num_workers = os.cpu_count()
+    # each rendered frame is 3.7 MB at 1280x720, so tasks are kept small
+    frames_per_task = 2
+    completed = False
+    try:
+        with multiprocessing.Pool(num_workers, initializer=setup_circle_figure,
+                                  initargs=(bins0.shape[1], circle_width)) as pool:
+            # limit how many rendered runs of frames wait in memory for ffmpeg
+            pending = collections.deque()
+            for i in range(0, bins0.shape[0], frames_per_task):
+                task = (centers[i:i + frames_per_task], radii[i:i + frames_per_task],
+                        frame_colors[i:i + frames_per_task])
+                pending.append(pool.apply_async(render_circle_frames, task))
+                if (len(pending) > num_workers):
+                    ffmpeg_process.stdin.write(pending.popleft().get())
+            while pending:
+                ffmpeg_process.stdin.write(pending.popleft().get())
+        ffmpeg_process.stdin.close()
+        completed = True
+    except BrokenPipeError:
+        # ffmpeg exited early; its return code is reported below
+        pass
+    except BaseException:
+        # stop ffmpeg so that it does not finish a truncated video
+        ffmpeg_process.kill()
+        raise
+    finally:
+        try:
+            ffmpeg_process.stdin.close()
+        except BrokenPipeError:
+            pass
+        ffmpeg_process.wait()
+        # do not leave a truncated video behind
+        if ((not completed or ffmpeg_process.returncode != 0) and os.path.exists(save_name)):
+            os.remove(save_name)
+
+    if (not completed or ffmpeg_process.returncode != 0):
+        raise subprocess.CalledProcessError(ffmpeg_process.returncode, command)
     print("time: ", time.time() - start)
-    # processing is done at 10fps so processing time is 3x running time
-
-
-def add_audio(input_video_filename, added_audio_filename, output_filename):
-    """
-    Adds original audio to the video.
-    Input: input_video_filename - the filename of the input video (generated from circle or bar function above), must be .mp4
-           added_audio_filename - the audio of the input video, must be .wav
-           output_filename - the filename of the output video, must be .mp4
-    """
-    input_video = ffmpeg.input(input_video_filename)
-    added_audio = ffmpeg.input(added_audio_filename).audio
 
-    (
-        ffmpeg
-            .concat(input_video, added_audio, v=1, a=1)
-            .output(output_filename)
-            .run(overwrite_output=True)
-    )
 
 if __name__ == '__main__':
     args = sys.argv
-    assert len(args) == 6 or len(args) == 7
+    assert len(args) == 5 or len(args) == 6
     assert args[1][-4:] == '.wav'
     assert args[2] in ['0', '1']
     assert args[3][-4:] == '.mp4'
-    assert args[4][-4:] == '.mp4'
-    assert args[5] in ['0', '1']
+    assert args[4] in ['0', '1']
     input_audio_filename = args[1]
     mono = int(args[2])
-    no_sound_video_output_filename = args[3]
-    with_sound_video_output_filename = args[4]
-    color_changing = int(args[5])
-    if(len(args) == 6):
+    video_output_filename = args[3]
+    color_changing = int(args[4])
+    if(len(args) == 5):
         circle_width = 15
     else:
-        circle_width = int(args[6])
+        circle_width = int(args[5])
     bins0, bins1 = wav_to_bins(input_audio_filename, mono=mono, bin_boundaries=[4, 37, 93, 371])
-    circle_mode(bins0, bins1, no_sound_video_output_filename, color_changing=color_changing, circle_width=circle_width)
-    add_audio(no_sound_video_output_filename, input_audio_filename, with_sound_video_output_filename)
\ No newline at end of file
+    circle_mode(bins0, bins1, video_output_filename, color_changing=color_changing, circle_width=circle_width,
+                audio_name=input_audio_filename)